@@ -0,0 +1,77 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _kappa_q(y1, y2, num_classes):
+    """
+    Quadratic weighted Cohen's kappa computed in a single pass over labels.
+    Follows the same conventions as `retinopathy.callbacks.cohen_kappa_score`: rows of confusion matrix are `y1`.
+
+    :param y1: Labels of first annotator, int64 array of shape [n_samples]
+    :param y2: Labels of second annotator, int64 array of shape [n_samples]
+    :param num_classes: Number of classes
+    :return: Tuple of (kappa, weighted observed matrix, weighted expected matrix)
+    """
+    n = y1.shape[0]
+    cm = np.zeros((num_classes, num_classes), dtype=np.float64)
+    for k in range(n):
+        cm[y1[k], y2[k]] += 1
+
+    sum0 = np.zeros(num_classes, dtype=np.float64)
+    sum1 = np.zeros(num_classes, dtype=np.float64)
+    for i in range(num_classes):
+        for j in range(num_classes):
+            sum0[j] += cm[i, j]
+            sum1[i] += cm[i, j]
+
+    num = np.zeros((num_classes, num_classes), dtype=np.float64)
+    denom = np.zeros((num_classes, num_classes), dtype=np.float64)
+    num_sum = 0.0
+    denom_sum = 0.0
+    for i in range(num_classes):
+        for j in range(num_classes):
+            w = (i - j) ** 2
+            num[i, j] = w * cm[i, j]
+            denom[i, j] = w * sum0[i] * sum1[j] / n
+            num_sum += num[i, j]
+            denom_sum += denom[i, j]
+
+    if denom_sum == 0:
+        # All labels belong to one class, kappa is undefined
+        return np.nan, num, denom
+    return 1.0 - num_sum / denom_sum, num, denom
+
+
+if njit is not None:
+    _kappa_q_jit = njit(cache=True, fastmath=True)(_kappa_q)
+    # Compile at import time to avoid paying JIT cost at the end of first epoch
+    _kappa_q_jit(np.array([0, 1], dtype=np.int64), np.array([1, 0], dtype=np.int64), 2)
+else:
+    _kappa_q_jit = _kappa_q
+
+
+def kappa_q(y1, y2, num_classes):
+    """
+    Quadratic weighted Cohen's kappa, see `_kappa_q`.
+    Labels are validated here, since compiled kernel does no bounds checking.
+
+    :param y1: Labels of first annotator, int64 array of shape [n_samples]
+    :param y2: Labels of second annotator, int64 array of shape [n_samples]
+    :param num_classes: Number of classes
+    :return: Tuple of (kappa, weighted observed matrix, weighted expected matrix)
+    """
+    if len(y1) != len(y2):
+        raise ValueError(f'Number of labels does not match: {len(y1)} and {len(y2)}')
+
+    if len(y1) == 0:
+        zeros = np.zeros((num_classes, num_classes), dtype=np.float64)
+        return np.nan, zeros, zeros.copy()
+
+    if min(y1.min(), y2.min()) < 0 or max(y1.max(), y2.max()) >= num_classes:
+        raise ValueError(f'Labels must be in range [0, {num_classes})')
+
+    return _kappa_q_jit(y1, y2, num_classes)
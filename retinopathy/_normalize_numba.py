@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Same defaults as in A.Normalize(), scaled to [0..255] range of uint8 images
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32) * 255
+IMAGENET_INV_STD = 1.0 / (np.array([0.229, 0.224, 0.225], dtype=np.float32) * 255)
+
+
+def _normalize_hwc_to_chw(image, mean, inv_std, out):
+    """
+    Normalize uint8 image and transpose it to CHW layout in a single pass.
+
+    :param image: uint8 array of shape [H, W, C]
+    :param mean: float32 array of shape [C]
+    :param inv_std: float32 array of shape [C]
+    :param out: float32 array of shape [C, H, W]
+    """
+    rows, cols, channels = image.shape
+    for i in range(rows):
+        for j in range(cols):
+            for c in range(channels):
+                out[c, i, j] = (image[i, j, c] - mean[c]) * inv_std[c]
+    return out
+
+
+if njit is not None:
+    # Not parallel, since it runs inside dataloader workers which already use all cores
+    _normalize_hwc_to_chw_jit = njit(cache=True, fastmath=True, nogil=True)(_normalize_hwc_to_chw)
+else:
+    _normalize_hwc_to_chw_jit = None
+
+
+def normalize_to_tensor(image: np.ndarray, mean=IMAGENET_MEAN, inv_std=IMAGENET_INV_STD) -> torch.Tensor:
+    """
+    Replacement for A.Normalize() followed by tensor_from_rgb_image.
+    Avoids intermediate float32 HWC image and HWC->CHW copy if Numba is available.
+
+    :param image: uint8 RGB image of shape [H, W, 3]
+    :return: float32 tensor of shape [3, H, W]
+    """
+    if _normalize_hwc_to_chw_jit is None:
+        image = (image.astype(np.float32) - mean) * inv_std
+        return torch.from_numpy(np.ascontiguousarray(np.moveaxis(image, -1, 0)))
+
+    out = np.empty((image.shape[2], image.shape[0], image.shape[1]), dtype=np.float32)
+    return torch.from_numpy(_normalize_hwc_to_chw_jit(image, mean, inv_std, out))
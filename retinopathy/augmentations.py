@@ -673,7 +673,14 @@ def get_hard_augmentations_v2(image_size):
     ])
 
 
-def get_train_transform(image_size, augmentation=None, preprocessing=None, crop_black=True):
+def get_train_transform(image_size, augmentation=None, preprocessing=None, crop_black=True, normalize=True,
+                        resize=True):
+    """
+    :param normalize: If False, A.Normalize() is not applied and uint8 images are returned,
+        so that RetinopathyDataset normalizes them with a fused kernel.
+    :param resize: If False, images are expected to be already resized and padded to `image_size`
+        (e.g. read from cache created by `prepare_cache`), so resize and padding are skipped.
+    """
     if augmentation is None:
         augmentation = 'none'
 
@@ -696,7 +703,7 @@ def get_train_transform(image_size, augmentation=None, preprocessing=None, crop_
     longest_size = max(image_size[0], image_size[1])
     return A.Compose([
         CropBlackRegions(tolerance=5) if crop_black else A.NoOp(always_apply=True),
-        A.LongestMaxSize(longest_size, interpolation=cv2.INTER_CUBIC),
+        A.LongestMaxSize(longest_size, interpolation=cv2.INTER_CUBIC) if resize else A.NoOp(always_apply=True),
 
         # Fake decease generation
         A.Compose([
@@ -705,23 +712,23 @@ def get_train_transform(image_size, augmentation=None, preprocessing=None, crop_
         ], p=float(artificial)),
 
         A.PadIfNeeded(image_size[0], image_size[1],
-                      border_mode=cv2.BORDER_CONSTANT, value=0),
+                      border_mode=cv2.BORDER_CONSTANT, value=0) if resize else A.NoOp(always_apply=True),
 
         augmentation,
         get_preprocessing_transform(preprocessing),
-        A.Normalize()
+        A.Normalize() if normalize else A.NoOp(always_apply=True)
     ])
 
 
-def get_test_transform(image_size, preprocessing: str = None, crop_black=True):
+def get_test_transform(image_size, preprocessing: str = None, crop_black=True, normalize=True, resize=True):
     longest_size = max(image_size[0], image_size[1])
     return A.Compose([
         CropBlackRegions(tolerance=5) if crop_black else A.NoOp(always_apply=True),
-        A.LongestMaxSize(longest_size, interpolation=cv2.INTER_CUBIC),
+        A.LongestMaxSize(longest_size, interpolation=cv2.INTER_CUBIC) if resize else A.NoOp(always_apply=True),
 
         A.PadIfNeeded(image_size[0], image_size[1],
-                      border_mode=cv2.BORDER_CONSTANT, value=0),
+                      border_mode=cv2.BORDER_CONSTANT, value=0) if resize else A.NoOp(always_apply=True),
 
         get_preprocessing_transform(preprocessing),
-        A.Normalize()
+        A.Normalize() if normalize else A.NoOp(always_apply=True)
     ])
@@ -1,6 +1,7 @@
 import itertools
 import os
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial, lru_cache
 from typing import List, Dict
 
 import math
@@ -11,13 +12,15 @@ import torch.nn.functional as F
 from catalyst.dl import MetricCallback, RunnerState, Callback, CriterionCallback, OptimizerCallback
 from catalyst.dl.callbacks import MixupCallback
 from catalyst.utils import get_optimizer_momentum
-from pytorch_toolbelt.utils.catalyst import get_tensorboard_logger
+from pytorch_toolbelt.utils.catalyst import get_tensorboard_logger, ShowPolarBatchesCallback
 from pytorch_toolbelt.utils.torch_utils import to_numpy
 from pytorch_toolbelt.utils.visualization import plot_confusion_matrix, render_figure_to_tensor
 from sklearn.metrics import confusion_matrix, f1_score, fbeta_score
 from torch import nn
 from torch.nn import Module
+from tqdm import tqdm
 
+from retinopathy._kappa_numba import kappa_q
 from retinopathy.models.ordinal import LogisticCumulativeLink
 from retinopathy.models.regression import regression_to_class
 from retinopathy.rounder import OptimizedRounder
@@ -81,17 +84,41 @@ def cohen_kappa_score(y1, y2, labels=None, weights=None, sample_weight=None):
     """
     confusion = confusion_matrix(y1, y2, labels=labels,
                                  sample_weight=sample_weight)
+    return _kappa_from_confusion(confusion, weights=weights)
+
+
+def _kappa_from_confusion(confusion, weights=None):
+    """
+    Compute Cohen's kappa from already accumulated confusion matrix.
+    :param confusion: Square matrix of shape [n_classes, n_classes]
+    :param weights: None, "linear" or "quadratic"
+    :return: Tuple of (kappa, weighted observed matrix, weighted expected matrix)
+    """
     n_classes = confusion.shape[0]
     sum0 = np.sum(confusion, axis=0)
     sum1 = np.sum(confusion, axis=1)
     expected = np.outer(sum0, sum1) / np.sum(sum0)
 
-    if weights is None:
-        w_mat = np.ones([n_classes, n_classes], dtype=np.int)
+    w_mat = _kappa_weight_matrix(n_classes, weights or 'none')
+
+    num = w_mat * confusion
+    denom = w_mat * expected
+    k = np.sum(num) / np.sum(denom)
+    return 1 - k, num, denom
+
+
+@lru_cache(maxsize=8)
+def _kappa_weight_matrix(n_classes: int, weights: str) -> np.ndarray:
+    """
+    Return read-only kappa weight matrix of shape [n_classes, n_classes].
+    Result is cached since it depends only on number of classes and weighting type.
+    """
+    if weights == "none":
+        w_mat = np.ones([n_classes, n_classes], dtype=np.int32)
         w_mat.flat[:: n_classes + 1] = 0
     elif weights == "linear" or weights == "quadratic":
-        w_mat = np.zeros([n_classes, n_classes], dtype=np.int)
-        w_mat += np.arange(n_classes)
+        w_mat = np.zeros([n_classes, n_classes], dtype=np.int32)
+        w_mat += np.arange(n_classes, dtype=np.int32)
         if weights == "linear":
             w_mat = np.abs(w_mat - w_mat.T)
         else:
@@ -99,10 +126,20 @@ def cohen_kappa_score(y1, y2, labels=None, weights=None, sample_weight=None):
     else:
         raise ValueError("Unknown kappa weighting type.")
 
-    num = w_mat * confusion
-    denom = w_mat * expected
-    k = np.sum(num) / np.sum(denom)
-    return 1 - k, num, denom
+    w_mat.flags.writeable = False
+    return w_mat
+
+
+# Matplotlib's pyplot is not thread-safe, so all figures are rendered by a single background worker
+_RENDER_POOL = ThreadPoolExecutor(max_workers=1)
+
+
+def _wait_pending(futures: List[Future]):
+    """
+    Wait for submitted rendering jobs and re-raise exceptions that may happen in them
+    """
+    while len(futures):
+        futures.pop(0).result()
 
 
 def plot_matrix(cm, class_names,
@@ -167,56 +204,94 @@ class CappaScoreCallback(Callback):
         self.prefix = prefix
         self.output_key = output_key
         self.input_key = input_key
-        self.targets = []
-        self.predictions = []
+        self.confusion = None
+        self._t_bufs = []
+        self._p_bufs = []
+        self._pending = []
         self.ignore_index = ignore_index
         self.from_regression = from_regression
         self.class_names = class_names
         self.optimize_thresholds = optimize_thresholds
 
     def on_loader_start(self, state):
-        self.targets = []
-        self.predictions = []
+        self.confusion = None
+        self._t_bufs = []
+        self._p_bufs = []
 
     def on_batch_end(self, state: RunnerState):
-
-        targets = to_numpy(state.input[self.input_key].detach())
-        outputs = to_numpy(state.output[self.output_key].detach())
+        targets = state.input[self.input_key].detach()
+        outputs = state.output[self.output_key].detach()
 
         if self.ignore_index is not None:
             mask = targets != self.ignore_index
             outputs = outputs[mask]
             targets = targets[mask]
 
-        self.targets.extend(targets)
-        self.predictions.extend(outputs)
-
-    def on_loader_end(self, state):
-        predictions = to_numpy(self.predictions)
-
         if self.from_regression:
-
+            num_classes = len(self.class_names) if self.class_names is not None else 5
             if self.optimize_thresholds:
-                rounder = OptimizedRounder()
-                coeff = rounder.fit(predictions, self.targets)
-                optimized_predictions = rounder.predict(predictions, coeff)
-                self._log(state, self.prefix + "_opt", optimized_predictions, self.targets)
+                # Threshold optimization needs raw predictions, so we have to keep them
+                self._t_bufs.append(targets.short().to('cpu', non_blocking=True))
+                self._p_bufs.append(outputs.float().to('cpu', non_blocking=True))
+            predictions = regression_to_class(outputs, max=num_classes - 1)
+        else:
+            num_classes = outputs.size(1)
+            predictions = outputs.argmax(dim=1)
 
-            predictions = regression_to_class(predictions)
+        # Rows of the confusion matrix are predictions, columns are targets
+        index = predictions.long() * num_classes + targets.long()
+        confusion = torch.bincount(index, minlength=num_classes * num_classes).view(num_classes, num_classes)
 
+        if self.confusion is None:
+            self.confusion = confusion
         else:
-            predictions = np.argmax(predictions, axis=1)
+            self.confusion += confusion
+
+    def on_loader_end(self, state):
+        if self.confusion is None or int(self.confusion.sum()) == 0:
+            # No labeled samples in this loader, kappa is undefined
+            state.metrics.epoch_values[state.loader_name][self.prefix] = np.nan
+            if self.from_regression and self.optimize_thresholds:
+                state.metrics.epoch_values[state.loader_name][self.prefix + "_opt"] = np.nan
+            return
+
+        if self.from_regression and self.optimize_thresholds:
+            if torch.cuda.is_available():
+                # Wait for pending non-blocking device to host copies
+                torch.cuda.synchronize()
+
+            targets = torch.cat(self._t_bufs).numpy().astype(np.int64)
+            predictions = torch.cat(self._p_bufs).numpy()
 
-        self._log(state, self.prefix, predictions, self.targets)
+            rounder = OptimizedRounder()
+            coeff = rounder.fit(predictions, targets)
+            optimized_predictions = rounder.predict(predictions, coeff).astype(np.int64)
 
-    def _log(self, state, prefix, predictions, targets):
-        score, num, denom = cohen_kappa_score(predictions, targets, weights='quadratic')
+            # Same as cohen_kappa_score, kappa is computed over labels present in predictions or targets
+            labels, inverse = np.unique(np.concatenate([optimized_predictions, targets]), return_inverse=True)
+            inverse = inverse.astype(np.int64)
+            self._log(state, self.prefix + "_opt",
+                      *kappa_q(inverse[:len(targets)], inverse[len(targets):], len(labels)),
+                      labels=labels)
 
+        confusion = to_numpy(self.confusion)
+        labels = np.flatnonzero(confusion.sum(axis=0) + confusion.sum(axis=1))
+        confusion = confusion[np.ix_(labels, labels)]
+        self._log(state, self.prefix, *_kappa_from_confusion(confusion, weights='quadratic'), labels=labels)
+
+    def _log(self, state, prefix, score, num, denom, labels):
         if self.class_names is None:
-            class_names = [str(i) for i in range(num.shape[1])]
+            class_names = [str(i) for i in labels]
         else:
-            class_names = self.class_names
+            class_names = [self.class_names[i] if i < len(self.class_names) else str(i) for i in labels]
+
+        state.metrics.epoch_values[state.loader_name][prefix] = score
 
+        logger = get_tensorboard_logger(state)
+        self._pending.append(_RENDER_POOL.submit(self._render, logger, state.step, prefix, class_names, num, denom))
+
+    @staticmethod
+    def _render(logger, step, prefix, class_names, num, denom):
         num_classes = len(class_names)
 
         num_fig = plot_matrix(num / np.sum(num),
@@ -232,10 +307,11 @@ class CappaScoreCallback(Callback):
         num_fig = render_figure_to_tensor(num_fig)
         denom_fig = render_figure_to_tensor(denom_fig)
 
-        logger = get_tensorboard_logger(state)
-        logger.add_image(f'{prefix}/epoch/num', num_fig, global_step=state.step)
-        logger.add_image(f'{prefix}/epoch/denom', denom_fig, global_step=state.step)
-        state.metrics.epoch_values[state.loader_name][prefix] = score
+        logger.add_image(f'{prefix}/epoch/num', num_fig, global_step=step)
+        logger.add_image(f'{prefix}/epoch/denom', denom_fig, global_step=step)
+
+    def on_stage_end(self, state: RunnerState):
+        _wait_pending(self._pending)
 
 
 class FScoreCallback(Callback):
@@ -265,17 +341,17 @@ class FScoreCallback(Callback):
         self.prefix = prefix
         self.output_key = output_key
         self.input_key = input_key
-        self.outputs = []
-        self.targets = []
+        self._o_bufs = []
+        self._t_bufs = []
         self.ignore_index = ignore_index
 
     def on_loader_start(self, state):
-        self.outputs = []
-        self.targets = []
+        self._o_bufs = []
+        self._t_bufs = []
 
     def on_batch_end(self, state: RunnerState):
-        outputs = to_numpy(state.output[self.output_key])
-        targets = to_numpy(state.input[self.input_key])
+        outputs = state.output[self.output_key].detach()
+        targets = state.input[self.input_key].detach()
 
         if self.ignore_index is not None:
             mask = targets != self.ignore_index
@@ -285,15 +361,18 @@ class FScoreCallback(Callback):
         if self.from_regression:
             outputs = regression_to_class(outputs)
         else:
-            outputs = np.argmax(outputs, axis=1)
+            outputs = outputs.argmax(dim=1)
 
-        self.outputs.extend(outputs)
-        self.targets.extend(targets)
+        self._o_bufs.append(outputs.short().to('cpu', non_blocking=True))
+        self._t_bufs.append(targets.short().to('cpu', non_blocking=True))
 
     def on_loader_end(self, state):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
         metric_name = self.prefix
-        y_true = np.array(self.targets)
-        y_pred = np.array(self.outputs)
+        y_true = torch.cat(self._t_bufs).numpy()
+        y_pred = torch.cat(self._o_bufs).numpy()
 
         metric = fbeta_score(y_true, y_pred, beta=self.beta, average=self.average)
         state.metrics.epoch_values[state.loader_name][metric_name] = float(metric)
@@ -316,13 +395,14 @@ def custom_accuracy_fn(outputs, targets, from_regression=False, ignore_index=Non
         return 0
 
     if from_regression:
-        outputs = regression_to_class(outputs).long()
+        # Rounded regression outputs are compared in their own dtype, without casting both sides to long
+        outputs = regression_to_class(outputs)
+        targets = targets.to(outputs.dtype)
     else:
         outputs = outputs.argmax(dim=1)
+        targets = targets.long()
 
-    correct = outputs.eq(targets.long())
-
-    acc = correct.float().sum() / batch_size
+    acc = (outputs == targets).float().mean()
     return acc
 
 
@@ -354,10 +434,11 @@ class CustomAccuracyCallback(MetricCallback):
         )
 
 
-class ConfusionMatrixCallbackFromRegression(Callback):
+class ConfusionMatrixCallback(Callback):
     """
     Compute and log confusion matrix to Tensorboard.
     For use with Multiclass classification/segmentation.
+    Confusion matrix is accumulated on device and copied to host once at the end of the loader.
     """
 
     def __init__(
@@ -373,52 +454,126 @@ class ConfusionMatrixCallbackFromRegression(Callback):
             specifies our `y_true`.
         :param output_key: output key to use for precision calculation;
             specifies our `y_pred`.
+        :param class_names: Names of classes. If None, number of classes is taken from the model output.
+        :param ignore_index: same meaning as in nn.CrossEntropyLoss
         """
         self.prefix = prefix
         self.class_names = class_names
         self.output_key = output_key
         self.input_key = input_key
-        self.outputs = []
-        self.targets = []
+        self.confusion = None
+        self._pending = []
         self.ignore_index = ignore_index
 
+    def get_predictions(self, outputs):
+        """
+        :return: Tuple of (predicted class indexes, number of classes)
+        """
+        num_classes = len(self.class_names) if self.class_names is not None else outputs.size(1)
+        return outputs.argmax(dim=1), num_classes
+
     def on_loader_start(self, state):
-        self.outputs = []
-        self.targets = []
+        self.confusion = None
 
     def on_batch_end(self, state: RunnerState):
-        outputs = to_numpy(regression_to_class(state.output[self.output_key].detach()))
-        targets = to_numpy(state.input[self.input_key])
+        outputs, num_classes = self.get_predictions(state.output[self.output_key].detach())
+        targets = state.input[self.input_key].detach()
 
+        # Ignored and out of range labels are dropped, like confusion_matrix(labels=range(num_classes)) does.
+        # Otherwise bincount fails on negative index or produces matrix of wrong size
+        mask = (targets >= 0) & (targets < num_classes) & (outputs < num_classes)
         if self.ignore_index is not None:
-            mask = targets != self.ignore_index
-            outputs = outputs[mask]
-            targets = targets[mask]
+            mask &= targets != self.ignore_index
+        outputs = outputs[mask]
+        targets = targets[mask]
 
-        self.outputs.extend(outputs)
-        self.targets.extend(targets)
+        # Rows of the confusion matrix are targets, columns are predictions
+        index = targets.long() * num_classes + outputs.long()
+        confusion = torch.bincount(index, minlength=num_classes * num_classes).view(num_classes, num_classes)
+
+        if self.confusion is None:
+            self.confusion = confusion
+        else:
+            self.confusion += confusion
 
     def on_loader_end(self, state):
-        targets = np.array(self.targets)
-        outputs = np.array(self.outputs)
+        if self.confusion is None:
+            return
 
-        if self.class_names is None:
-            class_names = [str(i) for i in range(targets.shape[1])]
-        else:
-            class_names = self.class_names
+        cm = to_numpy(self.confusion)
+        class_names = self.class_names
+        if class_names is None:
+            class_names = [str(i) for i in range(cm.shape[0])]
 
-        num_classes = len(class_names)
-        cm = confusion_matrix(targets, outputs, labels=range(num_classes))
+        logger = get_tensorboard_logger(state)
+        self._pending.append(_RENDER_POOL.submit(self._render, logger, state.step, self.prefix, class_names, cm))
 
+    @staticmethod
+    def _render(logger, step, prefix, class_names, cm):
+        num_classes = len(class_names)
         fig = plot_confusion_matrix(cm,
                                     figsize=(6 + num_classes // 3, 6 + num_classes // 3),
                                     class_names=class_names,
                                     normalize=True,
                                     noshow=True)
         fig = render_figure_to_tensor(fig)
+        logger.add_image(f'{prefix}/epoch', fig, global_step=step)
 
-        logger = get_tensorboard_logger(state)
-        logger.add_image(f'{self.prefix}/epoch', fig, global_step=state.step)
+    def on_stage_end(self, state: RunnerState):
+        _wait_pending(self._pending)
+
+
+class ConfusionMatrixCallbackFromRegression(ConfusionMatrixCallback):
+    """
+    Compute and log confusion matrix to Tensorboard.
+    For use with regression outputs, which are rounded to the nearest class.
+    """
+
+    def __init__(
+            self,
+            input_key: str = "targets",
+            output_key: str = "logits",
+            prefix: str = "confusion_matrix",
+            class_names=None,
+            ignore_index=None
+    ):
+        """
+        :param input_key: input key to use for precision calculation;
+            specifies our `y_true`.
+        :param output_key: output key to use for precision calculation;
+            specifies our `y_pred`.
+        :param class_names: Names of classes. If None, 5 classes of DR grades (0..4) are assumed.
+        """
+        if class_names is None:
+            class_names = [str(i) for i in range(5)]
+
+        super().__init__(input_key, output_key, prefix, class_names, ignore_index)
+
+    def get_predictions(self, outputs):
+        num_classes = len(self.class_names)
+        return regression_to_class(outputs, max=num_classes - 1), num_classes
+
+
+class PeriodicShowPolarBatchesCallback(ShowPolarBatchesCallback):
+    """
+    Visualize best and worst batch based in metric in Tensorboard every `every_n_epochs` epochs.
+    On other epochs batches are not tracked, so there are no copies of batches to host.
+    """
+
+    def __init__(self, visualize_batch, metric: str = "loss", minimize: bool = True, every_n_epochs=5, **kwargs):
+        super().__init__(visualize_batch, metric=metric, minimize=minimize, **kwargs)
+        self.every_n_epochs = every_n_epochs
+
+    def is_active(self, state: RunnerState):
+        return state.epoch % self.every_n_epochs == 0
+
+    def on_batch_end(self, state: RunnerState):
+        if self.is_active(state):
+            super().on_batch_end(state)
+
+    def on_loader_end(self, state: RunnerState):
+        if self.is_active(state):
+            super().on_loader_end(state)
 
 
 class RMSEMetric(Callback):
@@ -443,31 +598,33 @@ class RMSEMetric(Callback):
         self.class_names = class_names
         self.output_key = output_key
         self.input_key = input_key
-        self.outputs = []
-        self.targets = []
+        self.squared_error = 0
+        self.count = 0
         self.ignore_index = ignore_index
 
     def on_loader_start(self, state):
-        self.outputs = []
-        self.targets = []
+        self.squared_error = 0
+        self.count = 0
 
     def on_batch_end(self, state: RunnerState):
-        outputs = to_numpy(state.output[self.output_key])
-        targets = to_numpy(state.input[self.input_key])
+        outputs = state.output[self.output_key].detach()
+        targets = state.input[self.input_key].detach()
 
         if self.ignore_index is not None:
             mask = targets != self.ignore_index
             outputs = outputs[mask]
             targets = targets[mask]
 
-        self.outputs.extend(outputs)
-        self.targets.extend(targets)
+        # Sum of squared errors is accumulated on device, so no per-batch copy is needed
+        self.squared_error = self.squared_error + (targets.float() - outputs.float()).pow(2).sum()
+        self.count += targets.numel()
 
     def on_loader_end(self, state):
-        targets = np.array(self.targets).astype(np.float32)
-        outputs = np.array(self.outputs).astype(np.float32)
-
-        rmse = np.sqrt(np.square(targets - outputs).mean())
+        if self.count == 0:
+            # All targets were ignored
+            rmse = np.nan
+        else:
+            rmse = float(np.sqrt(float(self.squared_error) / self.count))
         state.metrics.epoch_values[state.loader_name][self.prefix] = rmse
 
 
@@ -540,17 +697,33 @@ class MixupSameLabelCallback(CriterionCallback):
         if not self.is_needed:
             return
 
-        targets = state.input[self.target_key]
-
-        for label_index in torch.arange(5):
-            mask = targets == label_index
-            lam = np.random.beta(self.alpha, self.alpha)
+        # One target per sample, either integer class or float grade of regression head
+        targets = state.input[self.target_key].view(-1)
+        num_classes = 5
+
+        # Samples are grouped by integer grade. Unlabeled samples and fractional targets form
+        # a separate group, which is left as is
+        labels = targets.long()
+        known = (labels == targets) & (labels >= 0) & (labels < num_classes)
+        groups = torch.where(known, labels, torch.full_like(labels, -1)).float()
+
+        # Sorting by group plus uniform noise gives two independent random orders,
+        # in which samples of each group occupy the same contiguous range.
+        # Pairing them gives a permutation that mixes samples only within the same group.
+        order_a = torch.argsort(groups + torch.rand(groups.size(), device=groups.device))
+        order_b = torch.argsort(groups + torch.rand(groups.size(), device=groups.device))
+        index = torch.empty_like(order_a)
+        index[order_a] = order_b
+
+        # Separate lambda per label
+        alpha = torch.full((num_classes,), self.alpha, device=targets.device)
+        lam = torch.distributions.Beta(alpha, alpha).sample()
+        lam = torch.where(known, lam[labels.clamp(0, num_classes - 1)], torch.ones_like(lam[0]))
 
-            index = torch.randperm(mask.shape[0])
-
-            for f in self.fields:
-                state.input[f][mask] = lam * state.input[f][mask] + \
-                                       (1 - lam) * state.input[f][mask][index]
+        for f in self.fields:
+            x = state.input[f]
+            lam_f = lam.view((-1,) + (1,) * (x.dim() - 1)).to(x.dtype)
+            state.input[f] = lam_f * x + (1 - lam_f) * x[index]
 
     def _compute_loss(self, state: RunnerState, criterion):
         # As we don't change target, compute basic loss
@@ -584,32 +757,29 @@ class MixupRegressionCallback(MixupCallback):
         super().__init__(fields, alpha, on_train_only, **kwargs)
 
     def on_batch_start(self, state: RunnerState):
-        if not self.is_needed:
-            return
+        # Reset state from previous batch, index is set only when mixup is applied
+        self.lam = 1.0
+        self.index = None
 
-        if self.alpha > 0:
-            self.lam = np.random.beta(self.alpha, self.alpha)
-        else:
-            self.lam = 1
+        if not self.is_needed or self.alpha <= 0:
+            return
 
-        if self.lam < 0.3 or self.lam > 0.7:
+        lam = np.random.beta(self.alpha, self.alpha)
+        if lam < 0.3 or lam > 0.7:
             # Do not apply mixup on small lambdas
             return
 
-        self.index = torch.randperm(state.input[self.fields[0]].shape[0])
-        self.index.to(state.device)
+        self.lam = lam
+        self.index = torch.randperm(state.input[self.fields[0]].shape[0], device=state.device)
 
         for f in self.fields:
             state.input[f] = self.lam * state.input[f] + \
                              (1 - self.lam) * state.input[f][self.index]
 
     def _compute_loss(self, state: RunnerState, criterion):
-        if not self.is_needed:
-            return super()._compute_loss(state, criterion)
-
-        if self.lam < 0.3 or self.lam > 0.7:
-            # Do not apply mixup on small lambdas
-            return super()._compute_loss(state, criterion)
+        if not self.is_needed or self.index is None:
+            # Bypass MixupCallback._compute_loss since there is nothing to mix
+            return CriterionCallback._compute_loss(self, state, criterion)
 
         pred = state.output[self.output_key]
         y_a: torch.Tensor = state.input[self.input_key]
@@ -618,8 +788,7 @@ class MixupRegressionCallback(MixupCallback):
 
         # In case of regression, if we do mixup of images of DR of different stages,
         # we assign the maximum stage as our target
-        mask = y_b > y_a
-        y = y_a.masked_scatter(mask, y_b[mask])
+        y = torch.max(y_a, y_b)
 
         loss = criterion(pred, y)
         return loss
@@ -737,9 +906,10 @@ class AscensionCallback(Callback):
         # We assume the cutpoints parameters are called `cutpoints`.
         if isinstance(module, LogisticCumulativeLink):
             cutpoints = module.cutpoints.data
-            for i in range(cutpoints.shape[0] - 1):
-                cutpoints[i].clamp_(self.min_val,
-                                    cutpoints[i + 1] - self.margin)
+            # Same as clamping each cutpoint[i] to [min_val, cutpoint[i + 1] - margin] in a loop,
+            # since the loop reads cutpoint[i + 1] before it is clipped itself.
+            upper = cutpoints[1:] - self.margin
+            cutpoints[:-1] = torch.min(cutpoints[:-1].clamp(min=self.min_val), upper)
 
     def on_batch_end(self, state: RunnerState):
         self.net.apply(self.clip)
@@ -763,31 +933,57 @@ class NegativeMiningCallback(Callback):
         self.output_key = output_key
         self.input_key = input_key
         self.from_regression = from_regression
-        self.image_ids = []
-        self.y_preds = []
-        self.y_preds_raw = []
-        self.y_trues = []
+        self._ids_bufs = []
+        self._pred_bufs = []
+        self._raw_bufs = []
+        self._true_bufs = []
         self.ignore_index = ignore_index
 
     def on_loader_start(self, state: RunnerState):
-        self.image_ids = []
-        self.y_preds_raw = []
-        self.y_preds = []
-        self.y_trues = []
+        self._ids_bufs = []
+        self._pred_bufs = []
+        self._raw_bufs = []
+        self._true_bufs = []
 
     def on_loader_end(self, state: RunnerState):
-        df = pd.DataFrame.from_dict({
-            'image_id': self.image_ids,
-            'y_true': self.y_trues,
-            'y_pred': self.y_preds,
-            'y_pred_raw': self.y_preds_raw
-        })
+        if not len(self._true_bufs):
+            return
+
+        y_true = torch.cat(self._true_bufs)
+        y_pred = torch.cat(self._pred_bufs)
+        y_pred_raw = torch.cat(self._raw_bufs)
+
+        negatives = y_true != y_pred
+        if self.ignore_index is not None:
+            negatives &= y_true != self.ignore_index
+
+        # Select negatives on device, so that only they are copied to host
+        index = negatives.nonzero(as_tuple=True)[0]
+        y_true = y_true.index_select(0, index).to('cpu', torch.int32).numpy()
+        y_pred = y_pred.index_select(0, index).to('cpu', torch.int32).numpy()
+        y_pred_raw = y_pred_raw.index_select(0, index).cpu().numpy()
+        image_ids = np.compress(negatives.cpu().numpy(), list(itertools.chain.from_iterable(self._ids_bufs)))
+
+        columns = {
+            'image_id': image_ids,
+            'y_true': y_true,
+            'y_pred': y_pred,
+        }
+
+        # Store raw predictions as plain numeric columns instead of column of numpy arrays
+        if y_pred_raw.ndim == 2:
+            for c in range(y_pred_raw.shape[1]):
+                columns[f'y_pred_raw_{c}'] = y_pred_raw[:, c]
+        else:
+            columns['y_pred_raw'] = y_pred_raw
 
         fname = os.path.join(state.logdir, 'negatives', state.loader_name, f'epoch_{state.epoch}.csv')
         os.makedirs(os.path.dirname(fname), exist_ok=True)
-        df.to_csv(fname, index=None)
+
+        pd.DataFrame.from_dict(columns).to_csv(fname, index=None, chunksize=4096, float_format='%.5f')
 
     def on_batch_end(self, state: RunnerState):
+        # Keep everything on device, negatives are selected once at the end of the loader
         y_true = state.input[self.input_key].detach()
         y_pred_raw = state.output[self.output_key].detach()
 
@@ -796,26 +992,81 @@ class NegativeMiningCallback(Callback):
         else:
             y_pred = torch.argmax(y_pred_raw, dim=1)
 
-        y_pred_raw = to_numpy(y_pred_raw)
-        y_pred = to_numpy(y_pred).astype(int)
-        y_true = to_numpy(y_true).astype(int)
-        image_ids = np.array(state.input['image_id'])
+        self._ids_bufs.append(state.input['image_id'])
+        self._raw_bufs.append(y_pred_raw)
+        self._pred_bufs.append(y_pred)
+        self._true_bufs.append(y_true)
 
-        if self.ignore_index is not None:
-            mask = y_true != self.ignore_index
-            y_pred_raw = y_pred_raw[mask]
-            y_pred = y_pred[mask]
-            y_true = y_true[mask]
-            image_ids = image_ids[mask]
-            if len(y_true) == 0:
-                return
 
-        negatives = y_true != y_pred
+class AutocastCallback(Callback):
+    """
+    Run forward pass of the model under native torch.autocast.
+    Autocast is entered on batch start and left on batch end, model outputs are cast back to float32,
+    so loss is computed in full precision. Must be placed before criterion and optimizer callbacks.
+    """
 
-        self.image_ids.extend(image_ids[negatives])
-        self.y_preds_raw.extend(y_pred_raw[negatives])
-        self.y_preds.extend(y_pred[negatives])
-        self.y_trues.extend(y_true[negatives])
+    def __init__(self, dtype=torch.float16):
+        self.dtype = dtype
+        self._autocast = None
+
+    def on_batch_start(self, state: RunnerState):
+        self._autocast = torch.autocast('cuda', dtype=self.dtype)
+        self._autocast.__enter__()
+
+    def on_batch_end(self, state: RunnerState):
+        if self._autocast is None:
+            return
+
+        self._autocast.__exit__(None, None, None)
+        self._autocast = None
+
+        for key, value in state.output.items():
+            if torch.is_tensor(value) and value.is_floating_point():
+                state.output[key] = value.float()
+
+
+class ChannelsLastCallback(Callback):
+    """
+    Convert input images to channels_last memory format, so that convolutions use NHWC kernels.
+    Model should be converted with `model.to(memory_format=torch.channels_last)` as well.
+    """
+
+    def __init__(self, input_key="image"):
+        self.input_key = input_key
+
+    def on_batch_start(self, state: RunnerState):
+        state.input[self.input_key] = state.input[self.input_key].contiguous(memory_format=torch.channels_last)
+
+
+class ThrottledProgressBarCallback(Callback):
+    """
+    Progress bar that is shown only for given loaders and refreshed at most every `mininterval` seconds.
+    Intended for use with `verbose=False`, instead of catalyst's verbose logger, which redraws
+    progress bar and batch metrics after each batch.
+    """
+
+    def __init__(self, loaders=("train",), miniters=10, mininterval=1.0):
+        self.loaders = loaders
+        self.miniters = miniters
+        self.mininterval = mininterval
+        self.progress_bar = None
+
+    def on_loader_start(self, state: RunnerState):
+        if state.loader_name in self.loaders:
+            self.progress_bar = tqdm(total=state.loader_len,
+                                     desc=f'Epoch {state.epoch} ({state.loader_name})',
+                                     miniters=self.miniters,
+                                     mininterval=self.mininterval,
+                                     leave=False)
+
+    def on_batch_end(self, state: RunnerState):
+        if self.progress_bar is not None:
+            self.progress_bar.update()
+
+    def on_loader_end(self, state: RunnerState):
+        if self.progress_bar is not None:
+            self.progress_bar.close()
+            self.progress_bar = None
 
 
 class LinearWeightDecayCallback(Callback):
@@ -849,12 +1100,14 @@ class CustomOptimizerCallback(OptimizerCallback):
         """
 
     def __init__(self, grad_clip_params: Dict = None, accumulation_steps: int = 1, optimizer_key: str = None,
-                 loss_key: str = None, prefix: str = None):
+                 loss_key: str = None, prefix: str = None, grad_scaler=None):
         """
         @TODO: docs
+        :param grad_scaler: Optional torch.cuda.amp.GradScaler to use for float16 mixed precision training
         """
 
         super().__init__(grad_clip_params, accumulation_steps, optimizer_key, loss_key, prefix)
+        self.grad_scaler = grad_scaler
 
     @staticmethod
     def grad_step(*, optimizer, optimizer_wd=0, grad_clip_fn=None):
@@ -891,6 +1144,8 @@ class CustomOptimizerCallback(OptimizerCallback):
 
     def on_batch_end(self, state):
         loss = state.get_key(key="loss", inner_key=self.loss_key)
+        if loss is None:
+            raise RuntimeError('Loss is not computed. CriterionCallback must be placed before CustomOptimizerCallback')
         if isinstance(loss, dict):
             loss = list(loss.values())
         if isinstance(loss, list):
@@ -914,7 +1169,9 @@ class CustomOptimizerCallback(OptimizerCallback):
         # change in future.
         # But alternative solution is to have AmpOptimizerCallback.
         # or expose another c'tor argument.
-        if hasattr(optimizer, "_amp_stash"):
+        if self.grad_scaler is not None:
+            self.grad_scaler.scale(loss).backward()
+        elif hasattr(optimizer, "_amp_stash"):
             from apex import amp
             with amp.scale_loss(loss, optimizer) as scaled_loss:
                 scaled_loss.backward()
@@ -922,12 +1179,22 @@ class CustomOptimizerCallback(OptimizerCallback):
             loss.backward()
 
         if (self._accumulation_counter + 1) % self.accumulation_steps == 0:
-            self.grad_step(
-                optimizer=optimizer,
-                optimizer_wd=self._optimizer_wd,
-                grad_clip_fn=self.grad_clip_fn
-            )
-            model.zero_grad()
+            if self.grad_scaler is not None:
+                # Gradients must be unscaled before clipping, scaler skips the step on inf/nan gradients
+                self.grad_scaler.unscale_(optimizer)
+                if self.grad_clip_fn is not None:
+                    for group in optimizer.param_groups:
+                        self.grad_clip_fn(group["params"])
+                self.grad_scaler.step(optimizer)
+                self.grad_scaler.update()
+            else:
+                self.grad_step(
+                    optimizer=optimizer,
+                    optimizer_wd=self._optimizer_wd,
+                    grad_clip_fn=self.grad_clip_fn
+                )
+            # Release gradients instead of filling them with zeros, next backward allocates them again
+            model.zero_grad(set_to_none=True)
             self._accumulation_counter = 0
 
     def on_epoch_end(self, state):
@@ -996,15 +1263,35 @@ class TSACriterionCallback(CriterionCallback):
         return loss
 
 
-def _kl_divergence_with_logits(p_logits: torch.Tensor, q_logits: torch.Tensor) -> torch.Tensor:
-    p = F.softmax(p_logits, dim=1)
+def _kl_divergence_with_logits(p_logits: torch.Tensor, q_logits: torch.Tensor, reduction='none') -> torch.Tensor:
+    """
+    KL(p||q) for distributions given by logits.
+    :param reduction: 'none' returns per-sample divergence, 'batchmean' returns its mean over batch
+    """
     log_p = F.log_softmax(p_logits, dim=1)
     log_q = F.log_softmax(q_logits, dim=1)
 
-    kl = torch.sum(p * (log_p - log_q), -1)
+    if reduction == 'batchmean':
+        return F.kl_div(log_q, log_p, reduction='batchmean', log_target=True)
+
+    kl = F.kl_div(log_q, log_p, reduction='none', log_target=True).sum(dim=1)
     return kl
 
 
+@torch.no_grad()
+def _teacher_forward(model: nn.Module, image: torch.Tensor, output_key: str) -> torch.Tensor:
+    """
+    Compute model outputs in eval mode without building autograd graph.
+    Used by UDA callbacks to get target distribution for unlabeled samples.
+    """
+    training = model.training
+    model.eval()
+    with torch.cuda.amp.autocast(enabled=image.is_cuda):
+        output = model(image.detach())[output_key]
+    model.train(training)
+    return output.float()
+
+
 class UDACriterionCallback(CriterionCallback):
     """
     # https://arxiv.org/pdf/1904.12848.pdf
@@ -1055,36 +1342,34 @@ class UDACriterionCallback(CriterionCallback):
             return
 
         targets = state.input[self.target_key]
-        loss_mask = (targets == self.unsupervised_label)  # Mask indicating unlabeled samples
-
-        loss_mask = loss_mask.float()  # Mask indicating unlabeled samples
+        unsupervised_mask = targets == self.unsupervised_label  # Mask indicating unlabeled samples
         aug_logits = state.output[self.output_key]
 
-        with torch.no_grad():
-            orig_image: torch.Tensor = state.input[self.input_key].detach()
-
-            # Compute target probability distribution
-            training = state.model.training
-            state.model.eval()
-            ori_logits_tgt = state.model(orig_image)[self.output_key]
-            state.model.train(training)
+        if not unsupervised_mask.any():
+            loss = torch.tensor(0, dtype=aug_logits.dtype, device=aug_logits.device)
+        else:
+            # Teacher distribution is needed only for unlabeled samples
+            aug_logits = aug_logits[unsupervised_mask]
+            ori_logits_tgt = _teacher_forward(state.model, state.input[self.input_key][unsupervised_mask],
+                                              self.output_key)
 
             if self.softmax_temperature is not None:
                 # Softmax temperature controlling. See Chapter 3.2
                 ori_logits_tgt = ori_logits_tgt / self.softmax_temperature
 
-        aug_loss = _kl_divergence_with_logits(p_logits=ori_logits_tgt,
-                                              q_logits=aug_logits)
+            if self.confidence_masking_threshold is not None:
+                aug_loss = _kl_divergence_with_logits(p_logits=ori_logits_tgt,
+                                                      q_logits=aug_logits)
 
-        if self.confidence_masking_threshold is not None:
-            # Confidence-based masking. See Chapter 3.2
-            ori_prob = F.log_softmax(ori_logits_tgt, dim=1).exp()
-            max_prob, max_idxs = torch.max(ori_prob, dim=1)
-            max_prob_mask = (max_prob > self.confidence_masking_threshold).float()
-            loss_mask = loss_mask * max_prob_mask
-
-        loss = aug_loss * loss_mask
-        loss = loss.sum() / loss_mask.sum().clamp_min(1)
+                # Confidence-based masking. See Chapter 3.2
+                ori_prob = F.softmax(ori_logits_tgt, dim=1)
+                max_prob, max_idxs = torch.max(ori_prob, dim=1)
+                loss_mask = (max_prob > self.confidence_masking_threshold).float()
+                loss = (aug_loss * loss_mask).sum() / loss_mask.sum().clamp_min(1)
+            else:
+                loss = _kl_divergence_with_logits(p_logits=ori_logits_tgt,
+                                                  q_logits=aug_logits,
+                                                  reduction='batchmean')
 
         state.metrics.add_batch_value(metrics_dict={
             self.prefix: loss.item(),
@@ -1139,24 +1424,18 @@ class UDARegressionCriterionCallback(CriterionCallback):
             return
 
         targets = state.input[self.target_key]
-        loss_mask = (targets == self.unsupervised_label)  # Mask indicating unlabeled samples
-
-        loss_mask = loss_mask.float()  # Mask indicating unlabeled samples
+        unsupervised_mask = targets == self.unsupervised_label  # Mask indicating unlabeled samples
         aug_regression = state.output[self.output_key]
 
-        with torch.no_grad():
-            orig_image: torch.Tensor = state.input[self.input_key].detach()
-
-            # Compute target probability distribution
-            training = state.model.training
-            state.model.eval()
-            ori_regression_tgt = state.model(orig_image)[self.output_key]
-            state.model.train(training)
-
-        aug_loss = F.mse_loss(aug_regression, ori_regression_tgt, reduction='none')
+        if not unsupervised_mask.any():
+            loss = torch.tensor(0, dtype=aug_regression.dtype, device=aug_regression.device)
+        else:
+            # Teacher targets are needed only for unlabeled samples
+            aug_regression = aug_regression[unsupervised_mask]
+            ori_regression_tgt = _teacher_forward(state.model, state.input[self.input_key][unsupervised_mask],
+                                                  self.output_key)
 
-        loss = aug_loss * loss_mask
-        loss = loss.sum() / loss_mask.sum().clamp_min(1)
+            loss = F.mse_loss(aug_regression, ori_regression_tgt.to(aug_regression.dtype))
 
         state.metrics.add_batch_value(metrics_dict={
             self.prefix: loss.item(),
@@ -9,11 +9,23 @@ import pandas as pd
 from pytorch_toolbelt.utils import fs
 from pytorch_toolbelt.utils.fs import id_from_fname
 from pytorch_toolbelt.utils.torch_utils import tensor_from_rgb_image
-from sklearn.model_selection import StratifiedKFold, train_test_split
+from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
 from sklearn.utils import compute_sample_weight
 from torch.utils.data import Dataset, DataLoader, WeightedRandomSampler
 
+from retinopathy._normalize_numba import normalize_to_tensor
 from retinopathy.augmentations import get_train_transform, get_test_transform
+from retinopathy.preprocessing import CropBlackRegions
+
+
+def worker_init_fn(worker_id):
+    """
+    Disable OpenCV's own thread pool inside dataloader workers, since it oversubscribes CPU
+    when images are decoded and augmented in several processes at once.
+
+    :param worker_id: Index of dataloader worker
+    """
+    cv2.setNumThreads(0)
 
 
 def get_class_names(coarse_grading=False):
@@ -42,7 +54,13 @@ class RetinopathyDataset(Dataset):
                  transform: A.Compose,
                  target_as_array=False,
                  dtype=int,
-                 meta_features=False):
+                 meta_features=False,
+                 cache_path=None):
+        """
+        :param cache_path: Optional directory with images cache created by `prepare_cache`.
+            Images found in cache (by image id) are read from memory-mapped array instead of decoding PNG files,
+            other images are decoded, cropped and resized the same way as cached ones.
+        """
         if targets is not None:
             targets = np.array(targets)
             unique_targets = set(targets)
@@ -56,15 +74,44 @@ class RetinopathyDataset(Dataset):
         self.target_as_array = target_as_array
         self.dtype = dtype
 
+        self.cache_path = cache_path
+        self.cache_index = None
+        self.cache_preprocess = None
+        self.cache = None  # Opened lazily, so memory-mapped array is not pickled to workers
+        if cache_path is not None:
+            if meta_features:
+                raise ValueError('Meta features require original image size and cannot be used with images cache')
+            cached_ids = np.load(os.path.join(cache_path, 'index.npy'))
+            self.cache_index = dict(zip(cached_ids, range(len(cached_ids))))
+
+            # Images missing in cache are preprocessed the same way, so they match cached ones
+            cache_shape = np.load(os.path.join(cache_path, 'images.npy'), mmap_mode='r').shape
+            self.cache_preprocess = get_cache_preprocess(cache_shape[1:3])
+
     def __len__(self):
         return len(self.images)
 
-    def __getitem__(self, item):
-        image = cv2.imread(self.images[item])  # Read with OpenCV instead PIL. It's faster
+    def read_image(self, item):
+        fname = self.images[item]
+        if self.cache_index is not None:
+            index = self.cache_index.get(id_from_fname(fname))
+            if index is not None:
+                if self.cache is None:
+                    self.cache = np.load(os.path.join(self.cache_path, 'images.npy'), mmap_mode='r')
+                return np.array(self.cache[index])
+
+        image = cv2.imread(fname, cv2.IMREAD_COLOR)  # Read with OpenCV instead PIL. It's faster
         if image is None:
-            raise FileNotFoundError(self.images[item])
+            raise FileNotFoundError(fname)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
+        if self.cache_preprocess is not None:
+            image = self.cache_preprocess(image=image)['image']
+        return image
+
+    def __getitem__(self, item):
+        image = self.read_image(item)
+
         height, width = image.shape[:2]
         diagnosis = UNLABELED_CLASS
         if self.targets is not None:
@@ -72,7 +119,13 @@ class RetinopathyDataset(Dataset):
 
         data = self.transform(image=image, diagnosis=diagnosis)
         diagnosis = data['diagnosis']
-        data = {'image': tensor_from_rgb_image(data['image']),
+        if data['image'].dtype == np.uint8:
+            # Transform without normalization, normalize and convert to CHW tensor in one pass
+            image_tensor = normalize_to_tensor(data['image'])
+        else:
+            image_tensor = tensor_from_rgb_image(data['image'])
+
+        data = {'image': image_tensor,
                 'image_id': id_from_fname(self.images[item])}
 
         if self.meta_features:
@@ -100,6 +153,47 @@ class RetinopathyDataset(Dataset):
         return data
 
 
+def get_cache_preprocess(image_size):
+    """
+    Preprocessing applied to images stored in cache: crop black regions, resize and pad to `image_size`
+    """
+    return A.Compose([
+        CropBlackRegions(tolerance=5),
+        A.LongestMaxSize(max(image_size[0], image_size[1]), interpolation=cv2.INTER_CUBIC),
+        A.PadIfNeeded(image_size[0], image_size[1], border_mode=cv2.BORDER_CONSTANT, value=0),
+    ])
+
+
+def prepare_cache(images, cache_path, image_size):
+    """
+    Decode images once, crop black regions, resize and pad them to `image_size` and store them
+    in a single uint8 array [N, H, W, 3] that is memory-mapped by `RetinopathyDataset`.
+
+    :param images: List of image filenames
+    :param cache_path: Output directory, `images.npy` and `index.npy` are written there
+    :param image_size: Tuple of (height, width)
+    """
+    images = np.array(images, dtype=str)
+    preprocess = get_cache_preprocess(image_size)
+
+    os.makedirs(cache_path, exist_ok=True)
+    cache = np.lib.format.open_memmap(os.path.join(cache_path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(len(images), image_size[0], image_size[1], 3))
+    for i, fname in enumerate(images):
+        image = cv2.imread(fname, cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(fname)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        cache[i] = preprocess(image=image)['image']
+
+    cache.flush()
+    del cache
+
+    # Index is written last, so incomplete cache is never picked up.
+    # Images are indexed by id, so lookup does not depend on how data directory is spelled
+    np.save(os.path.join(cache_path, 'index.npy'), np.array([id_from_fname(fname) for fname in images]))
+
+
 class RetinopathyDatasetV2(Dataset):
     """
     Implementation of dataset for use with unsupervised learning
@@ -202,11 +296,13 @@ def split_train_valid(x, y, fold=None, folds=4, random_state=42):
                 valid_y = y[test_index]
                 break
     else:
-        train_x, valid_x, train_y, valid_y = train_test_split(x, y,
-                                                              random_state=random_state,
-                                                              test_size=1.0 / folds,
-                                                              shuffle=True,
-                                                              stratify=y)
+        # Same split as train_test_split(stratify=y), but only indexes are computed
+        sss = StratifiedShuffleSplit(n_splits=1, test_size=1.0 / folds, random_state=random_state)
+        train_index, test_index = next(sss.split(np.zeros(len(y)), y))
+        train_x = x[train_index]
+        train_y = y[train_index]
+        valid_x = x[test_index]
+        valid_y = y[test_index]
 
     assert len(train_x) and len(train_y) and len(valid_x) and len(valid_y)
     assert len(train_x) == len(train_y)
@@ -1176,9 +1272,11 @@ def get_dataloaders(train_ds, valid_ds,
     train_dl = DataLoader(train_ds, batch_size=batch_size,
                           shuffle=sampler is None, sampler=sampler,
                           pin_memory=True, drop_last=True,
-                          num_workers=num_workers)
+                          num_workers=num_workers,
+                          worker_init_fn=worker_init_fn)
     valid_dl = DataLoader(valid_ds, batch_size=batch_size, shuffle=False,
                           pin_memory=True, drop_last=False,
-                          num_workers=num_workers)
+                          num_workers=num_workers,
+                          worker_init_fn=worker_init_fn)
 
     return train_dl, valid_dl
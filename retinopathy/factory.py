@@ -1,5 +1,8 @@
+import inspect
+import os
 from functools import partial
 
+import torch
 import torch.nn.functional as F
 from catalyst.contrib.schedulers import OneCycleLR, ExponentialLR
 from pytorch_toolbelt.modules import ABN
@@ -31,16 +34,30 @@ from retinopathy.models.pnasnet import pnasnet5large
 from retinopathy.opt import Lamb, AdamW, QHAdamW, RAdam, Ranger
 
 
+def maybe_compile(module: nn.Module) -> nn.Module:
+    """
+    Compile the module in place with CUDA graphs if RETINO_COMPILE=1 and Module.compile is available.
+    Parameter names in state_dict remain the same.
+    Requires static input shape (drop_last=True in train loader), otherwise each new shape triggers recompilation.
+    Not applied on multi-GPU hosts, since DataParallel replicas would call compiled function of the original module.
+    """
+    if os.environ.get('RETINO_COMPILE', '0') == '1' and hasattr(module, 'compile') and torch.cuda.device_count() <= 1:
+        module.compile(mode='reduce-overhead', dynamic=False)
+    return module
+
+
 class DenseNet121Encoder(EncoderModule):
     def __init__(self, pretrained=True):
         densenet = densenet121(pretrained=pretrained)
         super().__init__([1024], [32], [0])
         self.features = densenet.features
+        # Torchvision applies final ReLU in DenseNet.forward, here it is a part of features,
+        # so norm5 and relu5 are adjacent modules that can be fused
+        self.features.add_module('relu5', nn.ReLU(inplace=True))
+        maybe_compile(self.features)
 
     def forward(self, x):
-        x = self.features(x)
-        x = F.relu(x, inplace=True)
-        return [x]
+        return [self.features(x)]
 
 
 class DenseNet169Encoder(EncoderModule):
@@ -48,11 +65,13 @@ class DenseNet169Encoder(EncoderModule):
         densenet = densenet169(pretrained=pretrained)
         super().__init__([1664], [32], [0])
         self.features = densenet.features
+        # Torchvision applies final ReLU in DenseNet.forward, here it is a part of features,
+        # so norm5 and relu5 are adjacent modules that can be fused
+        self.features.add_module('relu5', nn.ReLU(inplace=True))
+        maybe_compile(self.features)
 
     def forward(self, x):
-        x = self.features(x)
-        x = F.relu(x, inplace=True)
-        return [x]
+        return [self.features(x)]
 
 
 class DenseNet201Encoder(EncoderModule):
@@ -60,11 +79,13 @@ class DenseNet201Encoder(EncoderModule):
         densenet = densenet201(pretrained=pretrained)
         super().__init__([1920], [32], [0])
         self.features = densenet.features
+        # Torchvision applies final ReLU in DenseNet.forward, here it is a part of features,
+        # so norm5 and relu5 are adjacent modules that can be fused
+        self.features.add_module('relu5', nn.ReLU(inplace=True))
+        maybe_compile(self.features)
 
     def forward(self, x):
-        x = self.features(x)
-        x = F.relu(x, inplace=True)
-        return [x]
+        return [self.features(x)]
 
 
 class PNasnet5LargeEncoder(EncoderModule):
@@ -79,6 +100,58 @@ class PNasnet5LargeEncoder(EncoderModule):
         return [x]
 
 
+try:
+    from inplace_abn import InPlaceABN
+
+    ABN_BLOCK = InPlaceABN
+except ImportError:
+    ABN_BLOCK = ABN
+
+ENCODERS = {
+    'resnet18': Resnet18Encoder,
+    'resnet34': Resnet34Encoder,
+    'resnet50': Resnet50Encoder,
+    'resnet101': Resnet101Encoder,
+    'resnet152': Resnet152Encoder,
+    'seresnext50': SEResNeXt50Encoder,
+    'seresnext50d': partial(DilatedSEResNeXt50Encoder, dropout=0.25),
+    'seresnext101': SEResNeXt101Encoder,
+    'seresnext101d': partial(DilatedSEResNeXt101Encoder, dropout=0.25),
+    'seresnet152': SEResnet152Encoder,
+    'senet154': SENet154Encoder,
+    'densenet121': DenseNet121Encoder,
+    'densenet169': DenseNet169Encoder,
+    'densenet201': DenseNet201Encoder,
+    'inceptionv4': InceptionV4Encoder,
+    'efficientb0': partial(EfficientNetB0ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb1': partial(EfficientNetB1ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb2': partial(EfficientNetB2ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb3': partial(EfficientNetB3ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb4': partial(EfficientNetB4ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb5': partial(EfficientNetB5ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb6': partial(EfficientNetB6ReLUEncoder, abn_block=ABN_BLOCK),
+    'efficientb7': partial(EfficientNetB7ReLUEncoder, abn_block=ABN_BLOCK),
+    'pnasnet5': PNasnet5LargeEncoder
+}
+
+HEADS = {
+    'gap': GlobalAvgPoolHead,
+    'gapv2': GlobalAvgPoolHeadV2,
+    'gwap': GlobalWeightedAvgPoolHead,
+    'rms': RMSPoolHead,
+    'max': GlobalMaxPoolHead,
+    'maxv2': GlobalMaxPoolHeadV2,
+    'fpn': FPNHeadModel,
+    'rank': RankPoolingHeadModel,
+    'rankv2': RankPoolingHeadModelV2,
+    'rnn': RNNHead
+}
+
+MODELS = {
+    'baseline': EncoderHeadModel,
+}
+
+
 def get_model(model_name, num_classes, pretrained=True, dropout=0.0, **kwargs):
     keys = model_name.split('_')
     if len(keys) == 2:
@@ -87,60 +160,14 @@ def get_model(model_name, num_classes, pretrained=True, dropout=0.0, **kwargs):
     else:
         model, encoder_name, head_name = keys
 
-    abn_block = ABN
-    try:
-        from inplace_abn import InPlaceABN
-        abn_block = InPlaceABN
-        print('Using InPlaceABN')
-    except:
+    if ABN_BLOCK is ABN:
         print('InplaceABN not available, using classic BatchNorm+Act')
-
-    ENCODERS = {
-        'resnet18': Resnet18Encoder,
-        'resnet34': Resnet34Encoder,
-        'resnet50': Resnet50Encoder,
-        'resnet101': Resnet101Encoder,
-        'resnet152': Resnet152Encoder,
-        'seresnext50': SEResNeXt50Encoder,
-        'seresnext50d': partial(DilatedSEResNeXt50Encoder, dropout=0.25),
-        'seresnext101': SEResNeXt101Encoder,
-        'seresnext101d': partial(DilatedSEResNeXt101Encoder, dropout=0.25),
-        'seresnet152': SEResnet152Encoder,
-        'senet154': SENet154Encoder,
-        'densenet121': DenseNet121Encoder,
-        'densenet169': DenseNet169Encoder,
-        'densenet201': DenseNet201Encoder,
-        'inceptionv4': InceptionV4Encoder,
-        'efficientb0': partial(EfficientNetB0ReLUEncoder, abn_block=abn_block),
-        'efficientb1': partial(EfficientNetB1ReLUEncoder, abn_block=abn_block),
-        'efficientb2': partial(EfficientNetB2ReLUEncoder, abn_block=abn_block),
-        'efficientb3': partial(EfficientNetB3ReLUEncoder, abn_block=abn_block),
-        'efficientb4': partial(EfficientNetB4ReLUEncoder, abn_block=abn_block),
-        'efficientb5': partial(EfficientNetB5ReLUEncoder, abn_block=abn_block),
-        'efficientb6': partial(EfficientNetB6ReLUEncoder, abn_block=abn_block),
-        'efficientb7': partial(EfficientNetB7ReLUEncoder, abn_block=abn_block),
-        'pnasnet5': PNasnet5LargeEncoder
-    }
+    else:
+        print('Using InPlaceABN')
 
     encoder = ENCODERS[encoder_name](pretrained=pretrained)
-
-    HEADS = {
-        'gap': GlobalAvgPoolHead,
-        'gapv2': GlobalAvgPoolHeadV2,
-        'gwap': GlobalWeightedAvgPoolHead,
-        'rms': RMSPoolHead,
-        'max': GlobalMaxPoolHead,
-        'maxv2': GlobalMaxPoolHeadV2,
-        'fpn': FPNHeadModel,
-        'rank': RankPoolingHeadModel,
-        'rankv2': RankPoolingHeadModelV2,
-        'rnn': RNNHead
-    }
-
-    MODELS = {
-        'baseline': EncoderHeadModel,
-    }
-
+    if encoder_name == 'inceptionv4':
+        maybe_compile(encoder.features)
     head = HEADS[head_name](feature_maps=encoder.output_filters, num_classes=num_classes, dropout=dropout)
 
     model = MODELS[model](encoder, head)
@@ -151,14 +178,26 @@ def get_optimizable_parameters(model: nn.Module):
     return filter(lambda x: x.requires_grad, model.parameters())
 
 
+def _fused_kwargs(optimizer_cls, kwargs):
+    """
+    Request fused CUDA implementation of the optimizer step (one kernel per parameter group)
+    if it is supported by installed PyTorch version and was not explicitly configured.
+    """
+    if 'fused' not in kwargs and torch.cuda.is_available() \
+            and 'fused' in inspect.signature(optimizer_cls.__init__).parameters:
+        kwargs = dict(kwargs, fused=True)
+    return kwargs
+
+
 def get_optimizer(optimizer_name: str, parameters, learning_rate: float, weight_decay=1e-5, **kwargs):
     if optimizer_name.lower() == 'sgd':
-        return SGD(parameters, learning_rate, momentum=0.9, nesterov=True, weight_decay=weight_decay, **kwargs)
+        return SGD(parameters, learning_rate, momentum=0.9, nesterov=True, weight_decay=weight_decay,
+                   **_fused_kwargs(SGD, kwargs))
 
     if optimizer_name.lower() == 'adam':
         return Adam(parameters, learning_rate, weight_decay=weight_decay,
                     eps=1e-3,  # As Jeremy suggests
-                    **kwargs)
+                    **_fused_kwargs(Adam, kwargs))
 
     if optimizer_name.lower() == 'rms':
         return RMSprop(parameters, learning_rate, weight_decay=weight_decay, **kwargs)
@@ -189,7 +228,29 @@ def get_optimizer(optimizer_name: str, parameters, learning_rate: float, weight_
     raise ValueError("Unsupported optimizer name " + optimizer_name)
 
 
+_LOSS_CACHE = {}
+
+
 def get_loss(loss_name: str, **kwargs):
+    """
+    Return loss module for given name. Instances are cached and shared between calls with the same arguments.
+    """
+    try:
+        key = (loss_name.lower(), frozenset(kwargs.items()))
+    except TypeError:
+        # Unhashable arguments (e.g. list of class weights), do not cache
+        key = None
+
+    if key is not None and key in _LOSS_CACHE:
+        return _LOSS_CACHE[key]
+
+    loss = _build_loss(loss_name, **kwargs)
+    if key is not None:
+        _LOSS_CACHE[key] = loss
+    return loss
+
+
+def _build_loss(loss_name: str, **kwargs):
     if loss_name.lower() == 'bce':
         return BCEWithLogitsLoss(**kwargs)
 
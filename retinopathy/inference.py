@@ -16,7 +16,7 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from retinopathy.augmentations import get_test_transform
-from retinopathy.dataset import get_class_names, RetinopathyDataset
+from retinopathy.dataset import get_class_names, RetinopathyDataset, worker_init_fn
 from retinopathy.factory import get_model
 from retinopathy.models.regression import regression_to_class
 from retinopathy.train_utils import report_checkpoint
@@ -98,6 +98,35 @@ class Flip4MultiheadTTA(nn.Module):
         return outputs[0]
 
 
+class BatchedTTA(nn.Module):
+    """
+    Flip/D4 TTA that concatenates all augmented copies of the batch along batch dimension,
+    runs a single forward pass and averages outputs of given keys.
+    Only non-spatial outputs (logits, regression, etc.) can be averaged this way.
+    """
+
+    COPIES = {'fliplr': 2, 'd4': 8}
+
+    def __init__(self, model, tta='fliplr', keys=('logits',)):
+        super().__init__()
+        if tta not in self.COPIES:
+            raise KeyError(tta)
+        self.model = model
+        self.tta = tta
+        self.keys = keys
+
+    def forward(self, image):
+        if self.tta == 'fliplr':
+            images = [image, FF.torch_fliplr(image)]
+        else:
+            # D4 group: 4 rotations of the image and of its transpose
+            images = [torch.rot90(x, k, dims=(2, 3)) for x in [image, image.transpose(2, 3)] for k in range(4)]
+
+        output = self.model(torch.cat(images, dim=0))
+        return dict((key, output[key].view(len(images), image.size(0), *output[key].shape[1:]).mean(dim=0))
+                    for key in self.keys)
+
+
 class ApplySoftmaxToLogits(nn.Module):
     def __init__(self):
         super().__init__()
@@ -175,7 +204,8 @@ def run_model_inference_via_dataset(model_checkpoint: str,
 
         data_loader = DataLoader(dataset, batch_size,
                                  pin_memory=True,
-                                 num_workers=workers)
+                                 num_workers=workers,
+                                 worker_init_fn=worker_init_fn)
 
         predictions = defaultdict(list)
 
@@ -253,7 +283,8 @@ def run_models_inference_via_dataset(model_checkpoints: List[str],
 
     data_loader = DataLoader(dataset, batch_size,
                              pin_memory=True,
-                             num_workers=workers)
+                             num_workers=workers,
+                             worker_init_fn=worker_init_fn)
 
     for batch in tqdm(data_loader):
         input = batch['image'].cuda(non_blocking=True)
@@ -2,45 +2,62 @@ from __future__ import absolute_import
 
 import argparse
 import collections
+import json
 import multiprocessing
 import os
+import time
 from datetime import datetime
 from functools import partial
 
+import numpy as np
 import pandas as pd
 import torch
-from catalyst.dl import SupervisedRunner, EarlyStoppingCallback, AUCCallback
+from catalyst.dl import SupervisedRunner, EarlyStoppingCallback, AUCCallback, CriterionCallback
 from catalyst.dl.callbacks import F1ScoreCallback
 from catalyst.utils import load_checkpoint, unpack_checkpoint
 from pytorch_toolbelt.utils import fs
-from pytorch_toolbelt.utils.catalyst import ShowPolarBatchesCallback
 from pytorch_toolbelt.utils.random import set_manual_seed
 from pytorch_toolbelt.utils.torch_utils import maybe_cuda, count_parameters, to_numpy, set_trainable
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import StratifiedShuffleSplit
 from torch.optim.lr_scheduler import MultiStepLR
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from retinopathy.dataset import RetinopathyDataset
-from retinopathy.factory import get_model, get_loss, get_optimizer, get_optimizable_parameters, get_train_aug, get_test_aug
+from retinopathy.augmentations import get_train_transform, get_test_transform
+from retinopathy.callbacks import ChannelsLastCallback, AutocastCallback, CustomOptimizerCallback, \
+    PeriodicShowPolarBatchesCallback, ThrottledProgressBarCallback
+from retinopathy.dataset import RetinopathyDataset, prepare_cache, worker_init_fn
+from retinopathy.factory import get_model, get_loss, get_optimizer, get_optimizable_parameters
+from retinopathy.inference import BatchedTTA
 from retinopathy.visualization import draw_classification_predictions
 
+# Upper bound on memory pinned by dataloader prefetch queues before a warning is printed
+MAX_PREFETCH_BYTES = 4 * 2 ** 30
+
+
+def get_cache_path(data_dir, image_size):
+    return os.path.join(data_dir, f'cache_{image_size[0]}x{image_size[1]}')
+
 
 def get_dataloaders(data_dir, batch_size, num_workers,
-                    image_size, augmentation, fast):
+                    image_size, augmentation, fast, prefetch_factor=2, cache=False):
     train_csv = pd.read_csv(os.path.join(data_dir, 'train.csv'))
-    train_csv['id_code'] = train_csv['id_code'].apply(lambda x: os.path.join(data_dir, 'train_images', f'{x}.png'))
+    train_csv['id_code'] = os.path.join(data_dir, 'train_images', '') + train_csv['id_code'].astype(str) + '.png'
     train_csv['is_test'] = 0
 
     test_csv = pd.read_csv(os.path.join(data_dir, 'test.csv'))
-    test_csv['id_code'] = test_csv['id_code'].apply(lambda x: os.path.join(data_dir, 'test_images', f'{x}.png'))
+    test_csv['id_code'] = os.path.join(data_dir, 'test_images', '') + test_csv['id_code'].astype(str) + '.png'
     test_csv['is_test'] = 1
 
     dataset = pd.concat((train_csv[['id_code', 'is_test']], test_csv[['id_code', 'is_test']]))
-    x = dataset['id_code']
-    y = dataset['is_test']
-
-    train_x, valid_x, train_y, valid_y = train_test_split(x, y, random_state=42, test_size=0.1, shuffle=True, stratify=y)
+    x = dataset['id_code'].values
+    y = dataset['is_test'].values
+
+    # Same split as train_test_split(stratify=y), but only indexes are computed and paths are kept in numpy arrays
+    sss = StratifiedShuffleSplit(n_splits=1, test_size=0.1, random_state=42)
+    train_index, valid_index = next(sss.split(np.zeros(len(y)), y))
+    train_x, train_y = x[train_index], y[train_index]
+    valid_x, valid_y = x[valid_index], y[valid_index]
     if fast:
         train_x = train_x[:32]
         train_y = train_y[:32]
@@ -50,15 +67,89 @@ def get_dataloaders(data_dir, batch_size, num_workers,
 
         num_workers = 0
 
-    train_ds = RetinopathyDataset(train_x, train_y, transform=get_train_aug(image_size, augmentation), target_as_array=True)
-    valid_ds = RetinopathyDataset(valid_x, valid_y, transform=get_test_aug(image_size), target_as_array=True)
+    cache_path = None
+    if cache and not fast:
+        cache_path = get_cache_path(data_dir, image_size)
+        if not os.path.isfile(os.path.join(cache_path, 'index.npy')):
+            print('Building images cache in', cache_path)
+            prepare_cache(x, cache_path, image_size)
+
+    # Cached images are already cropped, resized and padded
+    preprocess = cache_path is None
+    train_transform = get_train_transform(image_size, augmentation, crop_black=preprocess, resize=preprocess, normalize=False)
+    valid_transform = get_test_transform(image_size, crop_black=preprocess, resize=preprocess, normalize=False)
 
-    train_dl = DataLoader(train_ds, batch_size=batch_size, shuffle=True, pin_memory=True, drop_last=True, num_workers=num_workers)
-    valid_dl = DataLoader(valid_ds, batch_size=batch_size, shuffle=False, pin_memory=True, drop_last=False, num_workers=num_workers)
+    train_ds = RetinopathyDataset(train_x, train_y, transform=train_transform, target_as_array=True, cache_path=cache_path)
+    valid_ds = RetinopathyDataset(valid_x, valid_y, transform=valid_transform, target_as_array=True, cache_path=cache_path)
+
+    # Keep workers alive between epochs instead of respawning them
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
+
+        # Each worker keeps prefetch_factor batches of float32 images in pinned memory
+        prefetch_bytes = prefetch_factor * num_workers * batch_size * 3 * image_size[0] * image_size[1] * 4
+        if prefetch_bytes > MAX_PREFETCH_BYTES:
+            print(f'Warning: prefetch queue takes {prefetch_bytes / 2 ** 30:.1f} GiB of pinned memory, '
+                  f'consider reducing number of workers or prefetch factor')
+
+    train_dl = DataLoader(train_ds, batch_size=batch_size, shuffle=True, pin_memory=True, drop_last=True, num_workers=num_workers, worker_init_fn=worker_init_fn, **worker_kwargs)
+    valid_dl = DataLoader(valid_ds, batch_size=batch_size, shuffle=False, pin_memory=True, drop_last=False, num_workers=num_workers, worker_init_fn=worker_init_fn, **worker_kwargs)
 
     return train_dl, valid_dl
 
 
+def autotune_dataloader(data_dir, batch_size, image_size, augmentation, max_workers, default_config,
+                        num_batches=20, num_epochs=3, cache=False):
+    """
+    Search for the number of workers and prefetch factor giving the fastest train loader.
+    Each configuration is timed over a few short epochs of `num_batches` batches.
+
+    :param default_config: Tuple of (num_workers, prefetch_factor) returned if no configuration could be timed
+    :return: Tuple of (num_workers, prefetch_factor)
+    """
+    step = max(torch.cuda.device_count(), 1)
+    best_config, best_time = None, float('inf')
+
+    for num_workers in range(step, max_workers + 1, step):
+        for prefetch_factor in [2, 4, 8]:
+            # Skip configurations which would pin too much host memory
+            prefetch_bytes = prefetch_factor * num_workers * batch_size * 3 * image_size[0] * image_size[1] * 4
+            if prefetch_bytes > MAX_PREFETCH_BYTES:
+                continue
+
+            train_dl, _ = get_dataloaders(data_dir=data_dir,
+                                          batch_size=batch_size,
+                                          num_workers=num_workers,
+                                          image_size=image_size,
+                                          augmentation=augmentation,
+                                          fast=False,
+                                          prefetch_factor=prefetch_factor,
+                                          cache=cache)
+            start = time.perf_counter()
+            try:
+                for _ in range(num_epochs):
+                    for _ in zip(range(num_batches), train_dl):
+                        pass
+                # Measured before workers are shut down, teardown time is not part of the loading speed
+                elapsed = time.perf_counter() - start
+            except (RuntimeError, OSError) as e:
+                # Workers may run out of shared memory
+                print(f'Workers {num_workers:3d} Prefetch {prefetch_factor} : failed', e)
+                continue
+            finally:
+                del train_dl
+
+            print(f'Workers {num_workers:3d} Prefetch {prefetch_factor} : {elapsed:.2f}s')
+            if elapsed < best_time:
+                best_config, best_time = (num_workers, prefetch_factor), elapsed
+
+    if best_config is None:
+        print('Dataloader autotuning failed for all configurations, using', default_config)
+        return default_config
+    return best_config
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--seed', type=int, default=42, help='Random seed')
@@ -73,19 +164,35 @@ def main():
     parser.add_argument('-l', '--criterion', type=str, default='bce', help='Criterion')
     parser.add_argument('-o', '--optimizer', default='Adam', help='Name of the optimizer')
     parser.add_argument('-c', '--checkpoint', type=str, default=None, help='Checkpoint filename to use as initial model weights')
-    parser.add_argument('-w', '--workers', default=multiprocessing.cpu_count(), type=int, help='Num workers')
+    parser.add_argument('-w', '--workers', default=min(8, multiprocessing.cpu_count()), type=int, help='Num workers')
+    parser.add_argument('--prefetch-factor', default=2, type=int, help='Number of batches loaded in advance by each worker')
+    parser.add_argument('--autotune-dataloader', '--autotune-workers', dest='autotune_dataloader', action='store_true',
+                        help='Search for the fastest number of workers and prefetch factor before training')
     parser.add_argument('-a', '--augmentations', default='hard', type=str, help='')
     parser.add_argument('-tta', '--tta', default=None, type=str, help='Type of TTA to use [fliplr, d4]')
     parser.add_argument('-tm', '--train-mode', default='random', type=str, help='')
     parser.add_argument('-rm', '--run-mode', default='fit_predict', type=str, help='')
     parser.add_argument('--transfer', default=None, type=str, help='')
     parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--compile', action='store_true', help='Compile model with torch.compile')
+    parser.add_argument('--cache', action='store_true', help='Read preprocessed images from memory-mapped cache in data directory')
 
     args = parser.parse_args()
     set_manual_seed(args.seed)
 
+    # Input size and batch size are fixed (drop_last=True), so cuDNN autotuner picks algorithms once
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+
+    # Allow TF32 tensor cores for float32 matmuls and convolutions on Ampere and newer GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    if hasattr(torch, 'set_float32_matmul_precision'):
+        torch.set_float32_matmul_precision('high')
+
     data_dir = args.data_dir
     num_workers = args.workers
+    prefetch_factor = args.prefetch_factor
     num_epochs = args.epochs
     batch_size = args.batch_size
     learning_rate = args.learning_rate
@@ -105,6 +212,21 @@ def main():
     run_predict = run_mode == 'fit_predict' or run_mode == 'predict'
 
     model = maybe_cuda(get_model(model_name, num_classes=1))
+    model = model.to(memory_format=torch.channels_last)
+
+    if args.compile:
+        if not hasattr(torch.nn.Module, 'compile'):
+            print('torch.compile is not available, using eager model')
+        elif torch.cuda.device_count() > 1:
+            # Catalyst wraps model into DataParallel, whose replicas would call compiled function of the original module
+            print('torch.compile is not supported with DataParallel, using eager model')
+        else:
+            import torch._dynamo
+            # Fall back to eager execution for graphs that fail to compile
+            torch._dynamo.config.suppress_errors = True
+            torch._dynamo.config.cache_size_limit = 1024
+            # Compiled in-place, so parameter names in checkpoints remain the same
+            model.compile(mode='default', fullgraph=False, dynamic=False)
 
     if args.transfer:
         transfer_checkpoint = fs.auto_file(args.transfer)
@@ -151,12 +273,23 @@ def main():
             except Exception as e:
                 print('Failed to restore optimizer state from checkpoint', e)
 
+        if args.autotune_dataloader and not fast:
+            num_workers, prefetch_factor = autotune_dataloader(data_dir=data_dir,
+                                                               batch_size=batch_size,
+                                                               image_size=image_size,
+                                                               augmentation=augmentations,
+                                                               max_workers=multiprocessing.cpu_count(),
+                                                               default_config=(num_workers, prefetch_factor),
+                                                               cache=args.cache)
+
         train_loader, valid_loader = get_dataloaders(data_dir=data_dir,
                                                      batch_size=batch_size,
                                                      num_workers=num_workers,
                                                      image_size=image_size,
                                                      augmentation=augmentations,
-                                                     fast=fast)
+                                                     fast=fast,
+                                                     prefetch_factor=prefetch_factor,
+                                                     cache=args.cache)
 
         loaders = collections.OrderedDict()
         loaders["train"] = train_loader
@@ -174,16 +307,21 @@ def main():
         log_dir = os.path.join('runs', prefix)
         os.makedirs(log_dir, exist_ok=False)
 
+        with open(os.path.join(log_dir, 'dl_config.json'), 'w') as f:
+            json.dump({'num_workers': num_workers, 'prefetch_factor': prefetch_factor}, f, indent=2)
+
         scheduler = MultiStepLR(optimizer,
                                 milestones=[10, 30, 50, 70, 90], gamma=0.5)
 
         print('Train session    :', prefix)
         print('\tFP16 mode      :', fp16)
+        print('\tCompile        :', args.compile)
         print('\tFast mode      :', args.fast)
         print('\tTrain mode     :', train_mode)
         print('\tEpochs         :', num_epochs)
         print('\tEarly stopping :', early_stopping)
         print('\tWorkers        :', num_workers)
+        print('\tPrefetch factor:', prefetch_factor)
         print('\tData dir       :', data_dir)
         print('\tLog dir        :', log_dir)
         print('\tAugmentations  :', augmentations)
@@ -201,10 +339,27 @@ def main():
         # model training
         visualization_fn = partial(draw_classification_predictions, class_names=['Train', 'Test'])
 
-        callbacks = [
+        callbacks = []
+        grad_scaler = None
+        if fp16:
+            # Native mixed precision, bfloat16 does not need loss scaling
+            bf16_supported = hasattr(torch.cuda, 'is_bf16_supported') and torch.cuda.is_bf16_supported()
+            amp_dtype = torch.bfloat16 if bf16_supported else torch.float16
+            if amp_dtype == torch.float16:
+                grad_scaler = torch.cuda.amp.GradScaler()
+            callbacks += [AutocastCallback(dtype=amp_dtype)]
+
+        callbacks += [
+            # Callbacks run in list order: autocast (if any), then loss, then backward and optimizer step.
+            # Catalyst would append default CriterionCallback after all user callbacks, too late for optimizer.
+            CriterionCallback(),
+            # Used instead of catalyst's OptimizerCallback, it resets gradients with set_to_none=True
+            CustomOptimizerCallback(grad_scaler=grad_scaler),
             F1ScoreCallback(),
             AUCCallback(),
-            ShowPolarBatchesCallback(visualization_fn, metric='f1_score', minimize=False),
+            PeriodicShowPolarBatchesCallback(visualization_fn, metric='f1_score', minimize=False),
+            ChannelsLastCallback(input_key='image'),
+            ThrottledProgressBarCallback(loaders=['train']),
         ]
 
         if early_stopping:
@@ -212,7 +367,6 @@ def main():
 
         runner = SupervisedRunner(input_key='image')
         runner.train(
-            fp16=fp16,
             model=model,
             criterion=criterion,
             optimizer=optimizer,
@@ -221,7 +375,7 @@ def main():
             loaders=loaders,
             logdir=log_dir,
             num_epochs=num_epochs,
-            verbose=True,
+            verbose=False,
             main_metric='auc',
             minimize_metric=False,
             state_kwargs={"cmd_args": vars(args)}
@@ -232,23 +386,41 @@ def main():
         best_checkpoint = load_checkpoint(fs.auto_file('best.pth', where=log_dir))
         unpack_checkpoint(best_checkpoint, model=model)
 
-        model.eval()
-        torch.no_grad()
+        # Training is done, so model can be converted to half precision for faster inference
+        model = model.eval().half()
 
         train_csv = pd.read_csv(os.path.join(data_dir, 'train.csv'))
-        train_csv['id_code'] = train_csv['id_code'].apply(lambda x: os.path.join(data_dir, 'train_images', f'{x}.png'))
-        test_ds = RetinopathyDataset(train_csv['id_code'], None, get_test_aug(image_size), target_as_array=True)
-        test_dl = DataLoader(test_ds, batch_size, pin_memory=True, num_workers=num_workers)
+        # Loader does not shuffle, so predictions come in the same order as in train.csv
+        test_ids = train_csv['id_code'].tolist()
+        train_csv['id_code'] = os.path.join(data_dir, 'train_images', '') + train_csv['id_code'].astype(str) + '.png'
+        cache_path = None
+        if args.cache and os.path.isfile(os.path.join(get_cache_path(data_dir, image_size), 'index.npy')):
+            cache_path = get_cache_path(data_dir, image_size)
+        preprocess = cache_path is None
+        test_transform = get_test_transform(image_size, crop_black=preprocess, resize=preprocess, normalize=False)
+        test_ds = RetinopathyDataset(train_csv['id_code'], None, test_transform, target_as_array=True, cache_path=cache_path)
+        # TTA copies are concatenated to the batch, so all of them are processed in a single forward pass
+        tta_copies = 1
+        if args.tta is not None:
+            model = BatchedTTA(model, tta=args.tta)
+            tta_copies = BatchedTTA.COPIES[args.tta]
+
+        # No gradients are stored during inference, so a larger batch fits into memory
+        test_dl = DataLoader(test_ds, max(1, batch_size * 4 // tta_copies), pin_memory=True, num_workers=num_workers,
+                             worker_init_fn=worker_init_fn)
 
-        test_ids = []
         test_preds = []
 
-        for batch in tqdm(test_dl, desc='Inference'):
-            input = batch['image'].cuda()
-            outputs = model(input)
-            predictions = to_numpy(outputs['logits'].sigmoid().squeeze(1))
-            test_ids.extend(batch['image_id'])
-            test_preds.extend(predictions)
+        # inference_mode is missing in older torch versions
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for batch in tqdm(test_dl, desc='Inference'):
+                # Batches are pinned by the loader (pin_memory handles dicts), so the copy overlaps with compute
+                input = batch['image'].cuda(non_blocking=True).to(dtype=torch.float16, memory_format=torch.channels_last)
+                outputs = model(input)
+                # Keep predictions on GPU, they are copied to host once after the loop
+                test_preds.append(outputs['logits'].float().sigmoid().squeeze(1))
+
+        test_preds = to_numpy(torch.cat(test_preds))
 
         df = pd.DataFrame.from_dict({'id_code': test_ids, 'is_test': test_preds})
         df.to_csv(os.path.join(log_dir, 'test_in_train.csv'), index=None)
@@ -11,7 +11,7 @@ from torch import nn
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from retinopathy.dataset import get_datasets, get_class_names
+from retinopathy.dataset import get_datasets, get_class_names, worker_init_fn
 from retinopathy.factory import get_model
 from retinopathy.inference import run_model_inference_via_dataset, \
     reg_predictions_to_submission
@@ -142,7 +142,8 @@ def evaluate_generalization(checkpoints, num_folds=4):
 
                     data_loader = DataLoader(valid_ds, batch_size * torch.cuda.device_count(),
                                              pin_memory=True,
-                                             num_workers=8)
+                                             num_workers=8,
+                                             worker_init_fn=worker_init_fn)
 
                     predictions = defaultdict(list)
                     for batch in tqdm(data_loader,
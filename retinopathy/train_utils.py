@@ -1,11 +1,10 @@
 from functools import partial
 
 from catalyst.dl import CriterionCallback
-from pytorch_toolbelt.utils.catalyst import ConfusionMatrixCallback, ShowPolarBatchesCallback
 
 from retinopathy.callbacks import CappaScoreCallback, CustomAccuracyCallback, NegativeMiningCallback, \
     TSACriterionCallback, UDACriterionCallback, UDARegressionCriterionCallback, ConfusionMatrixCallbackFromRegression, \
-    FScoreCallback, RMSEMetric
+    FScoreCallback, RMSEMetric, ConfusionMatrixCallback, PeriodicShowPolarBatchesCallback
 from retinopathy.dataset import UNLABELED_CLASS
 from retinopathy.factory import get_loss
 from retinopathy.visualization import draw_regression_predictions, draw_classification_predictions
@@ -89,7 +88,8 @@ def get_cls_callbacks(loss_name, num_classes, num_epochs, class_names, tsa=None,
             ConfusionMatrixCallback(
                 prefix='cls/confusion',
                 output_key=output_key,
-                class_names=class_names),
+                class_names=class_names,
+                ignore_index=UNLABELED_CLASS),
             NegativeMiningCallback(ignore_index=UNLABELED_CLASS),
         ]
 
@@ -97,7 +97,7 @@ def get_cls_callbacks(loss_name, num_classes, num_epochs, class_names, tsa=None,
         visualization_fn = partial(draw_classification_predictions,
                                    class_names=class_names)
         callbacks += [
-            ShowPolarBatchesCallback(visualization_fn, metric='cls/accuracy', minimize=False)]
+            PeriodicShowPolarBatchesCallback(visualization_fn, metric='cls/accuracy', minimize=False)]
     return callbacks, criterions
 
 
@@ -182,7 +182,7 @@ def get_reg_callbacks(loss_name, class_names, prefix='reg', output_key='regressi
                                    class_names=class_names,
                                    unsupervised_label=UNLABELED_CLASS)
         callbacks += [
-            ShowPolarBatchesCallback(visualization_fn, metric=f'{prefix}/accuracy', minimize=False)]
+            PeriodicShowPolarBatchesCallback(visualization_fn, metric=f'{prefix}/accuracy', minimize=False)]
 
     return callbacks, criterions
 
@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+import sklearn.metrics
+import torch
+
+from retinopathy.callbacks import cohen_kappa_score, _kappa_from_confusion
+
+
+@pytest.mark.parametrize('weights', [None, 'linear', 'quadratic'])
+def test_kappa_from_confusion(weights):
+    y_true = np.random.randint(0, 5, size=1000)
+    y_pred = np.random.randint(0, 5, size=1000)
+
+    confusion = np.bincount(y_pred * 5 + y_true, minlength=25).reshape(5, 5)
+    score, num, denom = _kappa_from_confusion(confusion, weights=weights)
+
+    expected = sklearn.metrics.cohen_kappa_score(y_pred, y_true, weights=weights)
+    assert pytest.approx(expected) == score
+    assert pytest.approx(expected) == cohen_kappa_score(y_pred, y_true, weights=weights)[0]
+
+
+def test_kappa_q():
+    from retinopathy._kappa_numba import kappa_q
+
+    y_true = np.random.randint(0, 5, size=1000).astype(np.int64)
+    y_pred = np.random.randint(0, 5, size=1000).astype(np.int64)
+
+    score, num, denom = kappa_q(y_pred, y_true, 5)
+    expected, expected_num, expected_denom = cohen_kappa_score(y_pred, y_true, labels=range(5), weights='quadratic')
+    assert pytest.approx(expected) == score
+    np.testing.assert_allclose(num, expected_num)
+    np.testing.assert_allclose(denom, expected_denom)
+
+
+def test_kappa_q_single_class():
+    from retinopathy._kappa_numba import kappa_q
+
+    y_true = np.zeros(100, dtype=np.int64)
+    y_pred = np.zeros(100, dtype=np.int64)
+
+    score, num, denom = kappa_q(y_pred, y_true, 5)
+    assert np.isnan(score)
+
+
+def test_confusion_matrix_callback_unlabeled():
+    from types import SimpleNamespace
+    from retinopathy.callbacks import ConfusionMatrixCallback
+
+    logits = torch.randn(200, 5)
+    targets = torch.randint(0, 5, size=(200,))
+    targets[::3] = -100
+
+    callback = ConfusionMatrixCallback(ignore_index=-100)
+    callback.on_loader_start(None)
+    for batch_logits, batch_targets in zip(logits.split(64), targets.split(64)):
+        state = SimpleNamespace(input={'targets': batch_targets}, output={'logits': batch_logits})
+        callback.on_batch_end(state)
+
+    # Same as confusion matrix computed by sklearn, which drops labels not in range
+    expected = sklearn.metrics.confusion_matrix(targets.numpy(), logits.argmax(dim=1).numpy(), labels=range(5))
+    np.testing.assert_array_equal(callback.confusion.numpy(), expected)
+
+
+def test_kappa_q_out_of_range():
+    from retinopathy._kappa_numba import kappa_q
+
+    with pytest.raises(ValueError):
+        kappa_q(np.array([0, 7], dtype=np.int64), np.array([1, 0], dtype=np.int64), 5)
+
+    with pytest.raises(ValueError):
+        kappa_q(np.array([0, 1], dtype=np.int64), np.array([-100, 0], dtype=np.int64), 5)
+
+
+def _run_callback(callback, targets, outputs, batch_size=64):
+    from collections import defaultdict
+    from types import SimpleNamespace
+
+    state = SimpleNamespace(loader_name='valid', step=0, epoch=0, metrics=SimpleNamespace(epoch_values=defaultdict(dict)))
+    callback.on_loader_start(state)
+    for batch_targets, batch_outputs in zip(targets.split(batch_size), outputs.split(batch_size)):
+        state.input = {'targets': batch_targets}
+        state.output = {'logits': batch_outputs}
+        callback.on_batch_end(state)
+    callback.on_loader_end(state)
+    return state.metrics.epoch_values['valid']
+
+
+def test_kappa_callback_labels_subset(monkeypatch):
+    from retinopathy import callbacks
+
+    monkeypatch.setattr(callbacks, 'get_tensorboard_logger', lambda state: None)
+    monkeypatch.setattr(callbacks.CappaScoreCallback, '_render', staticmethod(lambda *args: None))
+
+    # Only labels 0, 2 and 4 are present, so kappa weights are computed over these three labels
+    targets = torch.randint(0, 2, size=(200,)) * 2
+    targets[::5] = -100
+    logits = torch.randn(200, 5)
+    logits[:, 1:4] -= 100
+
+    metrics = _run_callback(callbacks.CappaScoreCallback(prefix='kappa'), targets, logits)
+
+    mask = targets != -100
+    expected = sklearn.metrics.cohen_kappa_score(logits.argmax(dim=1)[mask].numpy(), targets[mask].numpy(),
+                                                 weights='quadratic')
+    assert pytest.approx(expected) == metrics['kappa']
+
+
+def test_kappa_callback_empty_loader():
+    from retinopathy.callbacks import CappaScoreCallback
+
+    metrics = _run_callback(CappaScoreCallback(prefix='kappa'), torch.zeros(0, dtype=torch.long), torch.zeros(0, 5))
+    assert np.isnan(metrics['kappa'])
+
+    metrics = _run_callback(CappaScoreCallback(prefix='kappa'), torch.full((8,), -100), torch.randn(8, 5))
+    assert np.isnan(metrics['kappa'])
+
+
+@pytest.mark.parametrize('dtype', [torch.long, torch.float32])
+def test_mixup_same_label(dtype):
+    from types import SimpleNamespace
+    from retinopathy.callbacks import MixupSameLabelCallback
+
+    targets = torch.randint(0, 5, size=(64,)).to(dtype)
+    targets[::7] = -100
+    if dtype == torch.float32:
+        # Fractional regression targets do not belong to any class
+        targets[1::7] = 2.5
+
+    # Features are in [label, label + 0.5), mixing samples of the same label keeps them in this range
+    features = targets.view(-1, 1, 1, 1).float() + 0.5 * torch.rand(64, 3, 4, 4)
+    known = (targets >= 0) & (targets == targets.long())
+    original = features.clone()
+
+    state = SimpleNamespace(input={'features': features, 'targets': targets})
+    MixupSameLabelCallback().on_batch_start(state)
+    mixed = state.input['features']
+
+    assert not torch.allclose(mixed[known], original[known])
+    assert torch.equal(mixed[known].floor(), original[known].floor())
+    assert torch.equal(mixed[~known], original[~known])
+
+
+def test_ascension_clip():
+    from retinopathy.callbacks import AscensionCallback
+    from retinopathy.models.ordinal import LogisticCumulativeLink
+
+    module = LogisticCumulativeLink(num_classes=6, init_cutpoints='random')
+    module.cutpoints.data = torch.tensor([-5.0, 3.0, 1.0, 2.0, -1.0]) * 2
+
+    # Sequential clipping, as it was done before vectorization
+    margin, min_val = 0.1, -3.0
+    expected = module.cutpoints.data.clone()
+    for i in range(expected.shape[0] - 1):
+        expected[i].clamp_(min_val, expected[i + 1] - margin)
+
+    AscensionCallback(module, margin=margin, min_val=min_val).clip(module)
+    assert torch.allclose(module.cutpoints.data, expected)
+
+
+def test_negative_mining(tmp_path):
+    import pandas as pd
+    from types import SimpleNamespace
+    from retinopathy.callbacks import NegativeMiningCallback
+
+    logits = torch.randn(100, 5)
+    targets = torch.randint(0, 5, size=(100,))
+    targets[::6] = -100
+    image_ids = [f'image_{i}' for i in range(100)]
+
+    callback = NegativeMiningCallback(ignore_index=-100)
+    state = SimpleNamespace(logdir=str(tmp_path), loader_name='valid', epoch=0)
+    callback.on_loader_start(state)
+    for start in range(0, 100, 32):
+        state.input = {'targets': targets[start:start + 32], 'image_id': image_ids[start:start + 32]}
+        state.output = {'logits': logits[start:start + 32]}
+        callback.on_batch_end(state)
+    callback.on_loader_end(state)
+
+    # Same negatives as selected per batch with numpy before buffering on device
+    y_pred = logits.argmax(dim=1).numpy()
+    y_true = targets.numpy()
+    negatives = (y_true != -100) & (y_true != y_pred)
+
+    df = pd.read_csv(str(tmp_path / 'negatives' / 'valid' / 'epoch_0.csv'))
+    assert df['image_id'].tolist() == list(np.array(image_ids)[negatives])
+    np.testing.assert_array_equal(df['y_true'].values, y_true[negatives])
+    np.testing.assert_array_equal(df['y_pred'].values, y_pred[negatives])
+    np.testing.assert_allclose(df[[f'y_pred_raw_{c}' for c in range(5)]].values, logits.numpy()[negatives], atol=1e-5)
+
+    # Nothing is written for loader without batches
+    state.loader_name = 'empty'
+    callback.on_loader_start(state)
+    callback.on_loader_end(state)
+    assert not (tmp_path / 'negatives' / 'empty').exists()
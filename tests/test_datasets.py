@@ -1,7 +1,8 @@
 from sklearn.utils import compute_sample_weight
 from torch.utils.data import WeightedRandomSampler, DataLoader
 
-from retinopathy.dataset import get_datasets
+from retinopathy.augmentations import get_test_transform
+from retinopathy.dataset import get_datasets, prepare_cache, RetinopathyDataset
 
 
 def test_aptos2019():
@@ -178,3 +179,20 @@ def test_balancing():
     plt.hist(hits)
     plt.title('Hits')
     plt.show()
+
+
+def test_images_cache(tmp_path):
+    image_size = (128, 128)
+    transform = get_test_transform(image_size, crop_black=False, resize=False, normalize=False)
+
+    prepare_cache(['4_left.png', '35_left.png'], str(tmp_path / 'cache'), image_size)
+    prepare_cache(['44_right.png'], str(tmp_path / 'expected'), image_size)
+    expected = np.load(str(tmp_path / 'expected' / 'images.npy'))
+
+    # Cache is looked up by image id, image that is not in cache is preprocessed the same way
+    ds = RetinopathyDataset(['./4_left.png', '44_right.png'], [0, 1], transform, cache_path=str(tmp_path / 'cache'))
+    assert ds.read_image(0).shape == (128, 128, 3)
+    np.testing.assert_array_equal(ds.read_image(1), expected[0])
+
+    for i in range(len(ds)):
+        assert ds[i]['image'].shape == (3, 128, 128)
@@ -158,3 +158,20 @@ def test_magnet_loss():
 
     l = loss(x, y)
     print(l)
+
+
+def test_get_loss_cache():
+    from retinopathy.factory import get_loss
+
+    loss_fn = get_loss('ce', ignore_index=-100)
+    assert loss_fn is get_loss('ce', ignore_index=-100)
+    assert loss_fn is not get_loss('ce')
+
+    logits = torch.randn(16, 5)
+    targets = torch.randint(0, 5, size=(16,))
+    targets[::4] = -100
+    assert torch.allclose(loss_fn(logits, targets), F.cross_entropy(logits, targets, ignore_index=-100))
+
+    # Unhashable arguments are not cached, but do not fail either
+    with pytest.raises(KeyError):
+        get_loss('unknown', weight=[1.0, 2.0, 1.0, 1.0, 1.0])
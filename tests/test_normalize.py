@@ -0,0 +1,15 @@
+import numpy as np
+
+from retinopathy._normalize_numba import normalize_to_tensor
+
+
+def test_normalize_to_tensor():
+    image = np.random.randint(0, 256, size=(64, 48, 3), dtype=np.uint8)
+
+    mean = np.array([0.485, 0.456, 0.406]) * 255
+    std = np.array([0.229, 0.224, 0.225]) * 255
+    expected = ((image - mean) / std).transpose(2, 0, 1)
+
+    actual = normalize_to_tensor(image)
+    assert actual.shape == (3, 64, 48)
+    np.testing.assert_allclose(actual.numpy(), expected, atol=1e-5)